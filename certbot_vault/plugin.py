@@ -2,15 +2,21 @@
 
 from __future__ import print_function
 
+import base64
+import functools
 import os
-import hvac
+import ssl
+import time
 import logging
 import requests
 import requests.adapters
 
-import OpenSSL.crypto
+from urllib3.util.retry import Retry
 
-from datetime import datetime
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.x509.oid import ExtensionOID
 from certbot import interfaces
 from certbot import errors
 from certbot.plugins import common
@@ -19,6 +25,64 @@ from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
+# Re-login when a cached token has less than this many seconds left.
+TOKEN_CACHE_MIN_TTL = 60
+
+# Skip the authentication check in prepare(), and in the token cache, if the
+# token was successfully used less than this many seconds ago.
+AUTH_CHECK_INTERVAL = 30
+
+# Authenticated clients keyed by the tuple of settings used to log in,
+# mapped to ``(client, expires_at, last_checked)``; last_checked is the
+# time.monotonic() time at which the token last proved valid.
+_client_cache = {}
+
+# Vault answers 429 when rate limiting and 503 when sealed or on standby,
+# without processing the request. These are the only failures after which
+# a POST is retried: a login that went through behind a 502/504 or a read
+# error may have consumed a single-use secret-id.
+POST_RETRY_STATUSES = frozenset((429, 503))
+
+
+class _VaultRetry(Retry):
+    """Retry policy only retrying POSTs that Vault did not process"""
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() == 'POST':
+            return status_code in POST_RETRY_STATUSES
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+# Connection pooling and retry policy for the sessions talking to Vault.
+# Retry honours Retry-After on 429 and 503 responses. Once retries are
+# exhausted the last response is returned, so that hvac still turns its
+# status into the matching VaultError.
+HTTP_ADAPTER_KWARGS = {
+    'pool_connections': 4,
+    'pool_maxsize': 8,
+    'max_retries': _VaultRetry(
+        total=3,
+        backoff_factor=0.2,
+        status_forcelist=(429, 502, 503, 504),
+        raise_on_status=False,
+    ),
+}
+
+# The settings passed to _login(), in the order it takes them.
+LOGIN_CONF_KEYS = (
+    'addr',
+    'tls-server-name',
+    'tls-cacert',
+    'token',
+    'role-id',
+    'secret-id',
+    'auth-path',
+    'jwt-role',
+    'jwt-key',
+)
+# Every setting VaultInstaller reads, looked up once per instance.
+CONF_KEYS = LOGIN_CONF_KEYS + ('mount', 'path', 'store-der', 'token-cache')
+
 
 class VaultInstaller(common.Installer, interfaces.RenewDeployer):
     description = "Vault Cert Installer"
@@ -72,47 +136,43 @@ class VaultInstaller(common.Installer, interfaces.RenewDeployer):
             default=os.getenv('VAULT_PATH'),
             help="Vault Path"
         )
+        add("store-der",
+            action="store_true",
+            default=False,
+            help=(
+                "Store the certificate, key and chain base64 DER encoded "
+                "(cert_der_b64, key_der_b64 and chain_der_b64) instead of "
+                "as PEM (cert, key and chain)"
+            ),
+        )
+        add("token-cache",
+            action="store_true",
+            default=False,
+            help=(
+                "Reuse the Vault client and token across certificates "
+                "instead of logging in again for each one"
+            ),
+        )
 
     def __init__(self, *args, **kwargs):
         super(VaultInstaller, self).__init__(*args, **kwargs)
-        if tls_cacert := self.conf("tls-cacert"):
-            ca_certs = Path(tls_cacert)
-        else:
-            ca_certs = None
-        if server_name := self.conf("tls-server-name"):
-            session = get_session_for_server_name(server_name, ca_certs)
+        self._conf = {k: self.conf(k) for k in CONF_KEYS}
+        conf = tuple(self._conf[k] for k in LOGIN_CONF_KEYS)
+        if self._conf['token-cache']:
+            self.hvac_client, self._last_auth_check = _get_authenticated_client(conf)
         else:
-            session = requests.Session()
-        self.hvac_client = hvac.Client(
-            url=self.conf('addr'),
-            session=session,
-        )
-
-        if self.conf('token'):
-            self.hvac_client.token = self.conf('token')
-
-        if self.conf('role-id') and self.conf('secret-id'):
-            auth_mount_point = self.conf('auth-path') or 'approle'
-            self.hvac_client.auth.approle.login(
-                self.conf('role-id'),
-                self.conf('secret-id'),
-                mount_point=auth_mount_point
-            )
-
-        if self.conf('jwt-role') and self.conf('jwt-key'):
-            self.hvac_client.auth.jwt.jwt_login(
-                self.conf('jwt-role'),
-                self.conf('jwt-key'),
-                path=self.conf('auth-path')
-            )
+            self.hvac_client, _, self._last_auth_check = _login(*conf)
 
     def prepare(self):  # pylint: disable=missing-docstring,no-self-use
         """
         Prepare the plugin
         """
 
+        if time.monotonic() - self._last_auth_check < AUTH_CHECK_INTERVAL:
+            return
         if not self.hvac_client.is_authenticated():
             raise errors.PluginError('Not authenticated')
+        self._last_auth_check = time.monotonic()
 
     def more_info(self):  # pylint: disable=missing-docstring,no-self-use
         """
@@ -121,7 +181,7 @@ class VaultInstaller(common.Installer, interfaces.RenewDeployer):
         return (
             "Hashicorp Vault Plugin",
             "Vault: %s" % (
-                self.conf('addr'),
+                self._conf['addr'],
             )
         )
 
@@ -141,46 +201,61 @@ class VaultInstaller(common.Installer, interfaces.RenewDeployer):
         :raises .PluginError: when cert cannot be deployed
         """
 
-        cert = open(cert_path).read()
-
-        date_format = "%Y%m%d%H%M%SZ"
+        cert = Path(cert_path).read_bytes()
+        key = Path(key_path).read_bytes()
+        chain = Path(fullchain_path).read_bytes()
 
-        openssl_cert = OpenSSL.crypto.load_certificate(
-            OpenSSL.crypto.FILETYPE_PEM,
-            cert
-        )
+        cert_obj = x509.load_pem_x509_certificate(cert, default_backend())
 
         data = {
             'type': 'urn:scheme:type:certificate',
-            'cert': cert,
-            'key': open(key_path).read(),
-            'chain': open(fullchain_path).read(),
-            'serial': str(openssl_cert.get_serial_number()),
+            'serial': str(cert_obj.serial_number),
             'life': {
-                'issued': int(datetime.strptime(openssl_cert.get_notBefore().decode(), date_format).timestamp()),
-                'expires': int(datetime.strptime(openssl_cert.get_notAfter().decode(), date_format).timestamp()),
+                'issued': int(cert_obj.not_valid_before_utc.timestamp()),
+                'expires': int(cert_obj.not_valid_after_utc.timestamp()),
             }
         }
-
-        domains = []
-        ext_count = openssl_cert.get_extension_count()
-        for i in range(0, ext_count):
-            ext = openssl_cert.get_extension(i)
-            if 'subjectAltName' in str(ext.get_short_name()):
-                sub = ext._subjectAltNameString()
-                for row in [x.strip() for x in sub.split(',')]:
-                    if row.startswith('DNS:'):
-                        domains.append(row[len('DNS:'):])
+        if self._conf['store-der']:
+            # The key was generated by certbot, skip the costly RSA consistency
+            # checks that would run on every deploy otherwise:
+            key_obj = serialization.load_pem_private_key(
+                key,
+                password=None,
+                backend=default_backend(),
+                unsafe_skip_rsa_key_validation=True,
+            )
+            data['cert_der_b64'] = _b64(cert_obj.public_bytes(serialization.Encoding.DER))
+            data['key_der_b64'] = _b64(key_obj.private_bytes(
+                serialization.Encoding.DER,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            ))
+            data['chain_der_b64'] = [
+                _b64(c.public_bytes(serialization.Encoding.DER))
+                for c in x509.load_pem_x509_certificates(chain)
+            ]
+        else:
+            data['cert'] = cert.decode()
+            data['key'] = key.decode()
+            data['chain'] = chain.decode()
+
+        try:
+            san = cert_obj.extensions.get_extension_for_oid(
+                ExtensionOID.SUBJECT_ALTERNATIVE_NAME
+            ).value
+            domains = san.get_values_for_type(x509.DNSName)
+        except x509.ExtensionNotFound:
+            domains = []
 
         if domains:
             data['domains'] = domains
 
         int_path = domain
-        if self.conf('path'):
-            int_path = os.path.join(self.conf('path'), domain)
+        if self._conf['path']:
+            int_path = os.path.join(self._conf['path'], domain)
 
         self.hvac_client.secrets.kv.v2.create_or_update_secret(
-            mount_point=self.conf('mount'),
+            mount_point=self._conf['mount'],
             path=int_path,
             secret=data
         )
@@ -225,21 +300,163 @@ class VaultInstaller(common.Installer, interfaces.RenewDeployer):
 interfaces.RenewDeployer.register(VaultInstaller)
 
 
+def _b64(der):
+    return base64.b64encode(der).decode('ascii')
+
+
+def _login(addr, tls_server_name, tls_cacert, token, role_id, secret_id,
+           auth_path, jwt_role, jwt_key):
+    """
+    Create a Vault client and authenticate it
+
+    :returns: the client, the time (as a Unix timestamp) at which its
+        token expires, and the :func:`time.monotonic` time at which the
+        token was checked by logging in, or -inf if it was not
+    :rtype: tuple
+    """
+    # hvac is only needed once the plugin is used, importing it lazily
+    # keeps it out of every other certbot invocation.
+    import hvac
+
+    if tls_cacert:
+        ca_certs = Path(tls_cacert)
+    else:
+        ca_certs = None
+    client_kwargs = {}
+    if tls_server_name and ca_certs:
+        # The SNIAdapter's SSLContext already trusts ca_certs. hvac would
+        # otherwise pass VAULT_CACERT on as `verify`, which requests turns
+        # into a CA file for urllib3 to load into that context again.
+        client_kwargs['verify'] = True
+    client = hvac.Client(
+        url=addr,
+        session=_get_session(addr, tls_server_name, ca_certs),
+        **client_kwargs
+    )
+
+    if token:
+        client.token = token
+
+    login_response = None
+    checked_at = float('-inf')
+    if role_id and secret_id:
+        login_response = client.auth.approle.login(
+            role_id,
+            secret_id,
+            mount_point=auth_path or 'approle'
+        )
+        checked_at = time.monotonic()
+
+    if jwt_role and jwt_key:
+        login_response = client.auth.jwt.jwt_login(
+            jwt_role,
+            jwt_key,
+            path=auth_path
+        )
+        checked_at = time.monotonic()
+
+    # A lease duration of 0 means the token never expires, and a token
+    # passed on the command line is not ours to renew.
+    lease_duration = 0
+    if login_response:
+        lease_duration = login_response['auth']['lease_duration']
+    if lease_duration:
+        expires_at = time.time() + lease_duration
+    else:
+        expires_at = float('inf')
+
+    return client, expires_at, checked_at
+
+
+def _get_authenticated_client(conf):
+    """
+    Return a cached authenticated Vault client for `conf`, logging in if
+    there is none or if its token is about to expire or was revoked
+
+    The token is only checked with lookup-self if it was not used in the
+    last `AUTH_CHECK_INTERVAL` seconds.
+
+    :param tuple conf: the positional arguments of :func:`_login`
+    :returns: the client and the :func:`time.monotonic` time at which its
+        token was last checked, or -inf if it was not
+    :rtype: tuple
+    """
+    import hvac.exceptions
+
+    cached = _client_cache.get(conf)
+    if cached is not None:
+        client, expires_at, last_checked = cached
+        if expires_at - time.time() >= TOKEN_CACHE_MIN_TTL:
+            if time.monotonic() - last_checked < AUTH_CHECK_INTERVAL:
+                return client, last_checked
+            try:
+                client.auth.token.lookup_self()
+            except hvac.exceptions.VaultError as e:
+                logger.debug("Cached Vault token is no longer valid: %s", e)
+            else:
+                last_checked = time.monotonic()
+                _client_cache[conf] = (client, expires_at, last_checked)
+                return client, last_checked
+
+    client, expires_at, checked_at = _login(*conf)
+    _client_cache[conf] = (client, expires_at, checked_at)
+    return client, checked_at
+
+
+@functools.lru_cache(maxsize=None)
+def _get_session(addr: str, server_name: str | None, ca_certs: Path | None) -> requests.Session:
+    """
+    Return the session shared by every client talking to `addr`, so that
+    connections to Vault are kept alive across installers
+    """
+    if server_name:
+        return get_session_for_server_name(server_name, ca_certs)
+    s = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(**HTTP_ADAPTER_KWARGS)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+
 def get_session_for_server_name(name: str, ca_certs: Path | None) -> requests.Session:
     s = requests.Session()
-    s.mount("https://", SNIAdapter(name, ca_certs))
+    s.mount("https://", SNIAdapter(name, ca_certs, **HTTP_ADAPTER_KWARGS))
     return s
 
 
+@functools.lru_cache(maxsize=8)
+def _make_ssl_context(ca_certs: Path) -> ssl.SSLContext:
+    """
+    Return an SSL context trusting `ca_certs`, shared by every adapter
+    using that CA bundle so that it is only parsed once
+    """
+    return ssl.create_default_context(cafile=str(ca_certs))
+
+
 class SNIAdapter(requests.adapters.HTTPAdapter):
 
     def __init__(self, server_name: str, ca_certs: Path | None, *args, **kwargs):
         self.server_name = server_name
         self.ca_certs = ca_certs
+        if ca_certs:
+            self.ssl_context = _make_ssl_context(ca_certs)
+        else:
+            self.ssl_context = None
         super().__init__(*args, **kwargs)
 
     def init_poolmanager(self, *args, **kwargs):
         kwargs["server_hostname"] = self.server_name
-        if self.ca_certs:
-            kwargs["ca_certs"] = str(self.ca_certs)
+        if self.ssl_context:
+            kwargs["ssl_context"] = self.ssl_context
         return super().init_poolmanager(*args, **kwargs)
+
+    def cert_verify(self, conn, url, verify, cert):
+        # requests sets the CA bundle on the connection pool before every
+        # request (certifi when verify is True), and urllib3 would load it
+        # into the shared SSLContext for each new connection. This relies
+        # on requests calling cert_verify() with the pool, as every 2.x
+        # release does, verify=True included (checked up to 2.34).
+        super().cert_verify(conn, url, verify, cert)
+        if self.ssl_context and verify:
+            conn.ca_certs = None
+            conn.ca_cert_dir = None
@@ -36,7 +36,7 @@ setup(
     install_requires=[
         'acme>=0.22.0',
         'certbot>=0.22.0',
-        'PyOpenSSL',
+        'cryptography>=42.0.0',
         'setuptools',
         'zope.component',
         'zope.event',
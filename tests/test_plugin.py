@@ -0,0 +1,282 @@
+"""Tests for certbot_vault.plugin."""
+
+import datetime
+import http.server
+import json
+import os
+import ssl
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import hvac.exceptions
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from urllib3.exceptions import MaxRetryError
+from urllib3.response import HTTPResponse
+
+from certbot_vault import plugin
+
+
+class _StatusHandler(http.server.BaseHTTPRequestHandler):
+    """Answer every request with the status code set on the server"""
+
+    def _reply(self):
+        self.server.hits += 1
+        self.send_response(self.server.status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_GET = do_POST = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+class VaultRetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.retry = plugin.HTTP_ADAPTER_KWARGS['max_retries']
+
+    def test_post_only_retried_when_vault_did_not_process_it(self):
+        self.assertTrue(self.retry.is_retry('POST', 429))
+        self.assertTrue(self.retry.is_retry('POST', 503))
+        self.assertFalse(self.retry.is_retry('POST', 502))
+        self.assertFalse(self.retry.is_retry('POST', 504))
+
+    def test_get_retried_on_status_forcelist(self):
+        for status in (429, 502, 503, 504):
+            self.assertTrue(self.retry.is_retry('GET', status))
+        self.assertFalse(self.retry.is_retry('GET', 500))
+
+    def test_increment_keeps_subclass(self):
+        retry = self.retry.increment(
+            method='POST', url='/', response=HTTPResponse(status=503),
+        )
+        self.assertIsInstance(retry, plugin._VaultRetry)
+        self.assertEqual(retry.total, self.retry.total - 1)
+        self.assertFalse(retry.is_retry('POST', 502))
+
+    def test_increment_raises_once_exhausted(self):
+        retry = self.retry
+        for _ in range(self.retry.total):
+            retry = retry.increment(
+                method='GET', url='/', response=HTTPResponse(status=502),
+            )
+        with self.assertRaises(MaxRetryError):
+            retry.increment(
+                method='GET', url='/', response=HTTPResponse(status=502),
+            )
+
+
+class SessionRetryTest(unittest.TestCase):
+    """Drive the retry policy through a real session and HTTP server"""
+
+    def setUp(self):
+        self.server = http.server.HTTPServer(("127.0.0.1", 0), _StatusHandler)
+        self.server.hits = 0
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = "http://127.0.0.1:%d/v1/secret" % self.server.server_port
+        self.session = plugin._get_session.__wrapped__(self.url, None, None)
+        patcher = mock.patch.object(plugin._VaultRetry, 'sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _request(self, method, status):
+        self.server.status = status
+        return self.session.request(method, self.url)
+
+    def test_post_retried_on_503_then_last_response_returned(self):
+        response = self._request('POST', 503)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.server.hits, self.retry_total() + 1)
+
+    def test_post_not_retried_on_502(self):
+        response = self._request('POST', 502)
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(self.server.hits, 1)
+
+    def test_get_retried_on_502_then_last_response_returned(self):
+        response = self._request('GET', 502)
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(self.server.hits, self.retry_total() + 1)
+
+    @staticmethod
+    def retry_total():
+        return plugin.HTTP_ADAPTER_KWARGS['max_retries'].total
+
+
+class AuthenticatedClientTest(unittest.TestCase):
+
+    conf = ('https://vault.example.com', None, None, None,
+            'role', 'secret', None, None, None)
+
+    def setUp(self):
+        plugin._client_cache.clear()
+        self.addCleanup(plugin._client_cache.clear)
+        patcher = mock.patch.object(plugin, '_login', side_effect=self._login)
+        self.login = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _login(self, *conf):
+        return mock.MagicMock(), plugin.time.time() + 3600, plugin.time.monotonic()
+
+    def _age_last_check(self):
+        client, expires_at, last_checked = plugin._client_cache[self.conf]
+        plugin._client_cache[self.conf] = (
+            client, expires_at, last_checked - plugin.AUTH_CHECK_INTERVAL,
+        )
+
+    def test_recently_checked_client_reused_without_lookup_self(self):
+        client, checked_at = plugin._get_authenticated_client(self.conf)
+        reused, reused_checked_at = plugin._get_authenticated_client(self.conf)
+        self.assertIs(reused, client)
+        self.assertEqual(reused_checked_at, checked_at)
+        self.login.assert_called_once_with(*self.conf)
+        client.auth.token.lookup_self.assert_not_called()
+
+    def test_client_reused_after_lookup_self(self):
+        client, _ = plugin._get_authenticated_client(self.conf)
+        self._age_last_check()
+        before = plugin.time.monotonic()
+        reused, checked_at = plugin._get_authenticated_client(self.conf)
+        self.assertIs(reused, client)
+        self.login.assert_called_once_with(*self.conf)
+        client.auth.token.lookup_self.assert_called_once_with()
+        self.assertGreaterEqual(checked_at, before)
+        self.assertEqual(plugin._client_cache[self.conf][2], checked_at)
+        # The successful check is remembered for the next installer:
+        plugin._get_authenticated_client(self.conf)
+        client.auth.token.lookup_self.assert_called_once_with()
+
+    def test_relogin_when_token_revoked(self):
+        client, _ = plugin._get_authenticated_client(self.conf)
+        client.auth.token.lookup_self.side_effect = hvac.exceptions.Forbidden()
+        self._age_last_check()
+        relogged, _ = plugin._get_authenticated_client(self.conf)
+        self.assertIsNot(relogged, client)
+        self.assertEqual(self.login.call_count, 2)
+        self.assertIs(plugin._client_cache[self.conf][0], relogged)
+
+    def test_relogin_when_token_about_to_expire(self):
+        client, _ = plugin._get_authenticated_client(self.conf)
+        plugin._client_cache[self.conf] = (
+            (client, plugin.time.time() + plugin.TOKEN_CACHE_MIN_TTL - 1)
+            + plugin._client_cache[self.conf][2:]
+        )
+        relogged, _ = plugin._get_authenticated_client(self.conf)
+        self.assertIsNot(relogged, client)
+        client.auth.token.lookup_self.assert_not_called()
+
+    def test_cache_keyed_by_login_settings(self):
+        client, _ = plugin._get_authenticated_client(self.conf)
+        other_conf = self.conf[:4] + ('other-role',) + self.conf[5:]
+        other, _ = plugin._get_authenticated_client(other_conf)
+        self.assertIsNot(other, client)
+        self.assertEqual(self.login.call_count, 2)
+
+
+def _make_cert(subject, issuer_cert=None, issuer_key=None, san=None):
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, subject)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    builder = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(issuer_cert.subject if issuer_cert else name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=1))
+        .not_valid_after(now + datetime.timedelta(hours=1))
+    )
+    if san:
+        builder = builder.add_extension(
+            x509.SubjectAlternativeName([x509.DNSName(san)]), critical=False,
+        )
+    else:
+        builder = builder.add_extension(
+            x509.BasicConstraints(ca=True, path_length=None), critical=True,
+        )
+    cert = builder.sign(issuer_key or key, hashes.SHA256())
+    return cert, key
+
+
+class _LookupSelfHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = json.dumps({'data': {}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class SNISessionTest(unittest.TestCase):
+
+    server_name = 'vault.test'
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        ca_cert, ca_key = _make_cert('Test CA')
+        cert, key = _make_cert(self.server_name, ca_cert, ca_key, san=self.server_name)
+        self.ca_path = os.path.join(tmp.name, 'ca.pem')
+        cert_path = os.path.join(tmp.name, 'cert.pem')
+        key_path = os.path.join(tmp.name, 'key.pem')
+        with open(self.ca_path, 'wb') as f:
+            f.write(ca_cert.public_bytes(serialization.Encoding.PEM))
+        with open(cert_path, 'wb') as f:
+            f.write(cert.public_bytes(serialization.Encoding.PEM))
+        with open(key_path, 'wb') as f:
+            f.write(key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            ))
+
+        server_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_ctx.load_cert_chain(cert_path, key_path)
+        self.server = http.server.HTTPServer(("127.0.0.1", 0), _LookupSelfHandler)
+        self.server.socket = server_ctx.wrap_socket(self.server.socket, server_side=True)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.addr = "https://127.0.0.1:%d" % self.server.server_port
+
+    def test_ca_bundle_only_loaded_once(self):
+        with mock.patch.dict(os.environ, {'VAULT_CACERT': self.ca_path}):
+            client, _, _ = plugin._login(
+                self.addr, self.server_name, self.ca_path, 'token',
+                None, None, None, None, None,
+            )
+        for _ in range(3):
+            self.assertTrue(client.is_authenticated())
+        ctx = plugin._make_ssl_context(plugin.Path(self.ca_path))
+        # Neither certifi nor the VAULT_CACERT path were loaded into the
+        # shared context on top of the CA it was built with:
+        self.assertEqual(ctx.cert_store_stats()['x509_ca'], 1)
+
+    def test_cert_verify_clears_ca_files(self):
+        adapter = plugin.SNIAdapter(self.server_name, plugin.Path(self.ca_path))
+        conn = mock.Mock()
+        adapter.cert_verify(conn, self.addr, True, None)
+        self.assertEqual(conn.cert_reqs, 'CERT_REQUIRED')
+        self.assertIsNone(conn.ca_certs)
+        self.assertIsNone(conn.ca_cert_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover